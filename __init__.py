@@ -1,12 +1,17 @@
+import bisect
 import configparser
+import heapq
 import json
 import re
 import shutil
 import sqlite3
 import tempfile
+import threading
+import unicodedata
 from contextlib import closing, contextmanager
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Iterator, NamedTuple
+from typing import Callable, Collection, Iterator, NamedTuple
 
 from albert import (  # pylint: disable=import-error
     Action,
@@ -27,13 +32,55 @@ md_maintainers = '@stevenxxiu'
 
 ICON_URL = 'xdg:firefox-developer-edition'
 FIREFOX_DATA_PATH = Path.home() / '.mozilla/firefox/'
+# Only this many of the best matching bookmarks are shown
+MAX_RESULTS = 50
+# Splits on at least every separator `Matcher` does
+SEPARATOR_RE = re.compile(r'[\W_]+')
 
 
-class Bookmark(NamedTuple):
-    name: str
-    url: str
+def normalize(s: str) -> str:
+    """
+    Folds case and diacritics like `Matcher` does. Every word of a query that `Matcher` matches is then a substring of
+    the normalized text.
+    """
+    s = s.lower()
+    if s.isascii():
+        return s
+    return ''.join(c for c in unicodedata.normalize('NFD', s) if not unicodedata.combining(c))
+
 
+def join_with_offsets(strs: list[str]) -> tuple[str, list[int]]:
+    """
+    :return: `strs` joined by newlines, and the offset each string starts at
+    """
+    offsets = []
+    offset = 0
+    for s in strs:
+        offsets.append(offset)
+        offset += len(s) + 1
+    return '\n'.join(strs), offsets
 
+
+def find_containing(blob: str, offsets: list[int], word: str) -> list[int]:
+    """
+    Searches the whole blob with `str.find`, jumping to the next string after each hit, instead of looping over every
+    string in Python.
+
+    :param word: must not contain newlines
+    :return: indices of the strings joined in `blob` which contain `word`, in order
+    """
+    indices = []
+    pos = blob.find(word)
+    while pos != -1:
+        i = bisect.bisect_right(offsets, pos) - 1
+        indices.append(i)
+        if i + 1 == len(offsets):
+            break
+        pos = blob.find(word, offsets[i + 1])
+    return indices
+
+
+@lru_cache(maxsize=1)
 def get_profile_path() -> Path:
     """
     :return: path of the last selected profile if it was used, or the dev profile
@@ -43,9 +90,10 @@ def get_profile_path() -> Path:
 
     last_used_profile = None
     dev_profile = None
-    for key, obj in profile.items():
-        if not re.match(r'Profile\d+', key):
+    for key in profile.sections():
+        if not (key.startswith('Profile') and key[7:].isdigit()):
             continue
+        obj = profile[key]
         # `Default = 1` indicates the profile was last used. Dev profiles don't have the setting.
         if obj.get('Default', None) == '1':
             last_used_profile = obj['Path']
@@ -59,42 +107,197 @@ def get_profile_path() -> Path:
     raise ValueError
 
 
+# We only read, so `journal_mode` and `synchronous` don't matter. Reads go through almost every row, so map the file and
+# use a larger page cache.
+READ_PRAGMAS = """
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+PRAGMA cache_size=-65536;
+"""
+
+
+def open_places_db_immutable(db_path: Path) -> sqlite3.Connection | None:
+    """
+    Opens the database in place. `immutable=1` skips locking, so this works even while *Firefox* holds its exclusive
+    lock.
+
+    :return: the connection, or `None` if the database can't be read this way
+    """
+    con = None
+    try:
+        con = sqlite3.connect(f'{db_path.as_uri()}?mode=ro&immutable=1', uri=True)
+        con.execute('PRAGMA schema_version')
+        return con
+    except sqlite3.OperationalError:
+        if con is not None:
+            con.close()
+        return None
+
+
 @contextmanager
 def open_places_db(profile_path: Path) -> Iterator[sqlite3.Connection]:
+    db_path = profile_path / 'places.sqlite'
+    wal_path = profile_path / 'places.sqlite-wal'
+
+    # An immutable database ignores the WAL, so only open in place if there's nothing in it
+    if not wal_path.exists() or wal_path.stat().st_size == 0:
+        con = open_places_db_immutable(db_path)
+        if con is not None:
+            with closing(con):
+                con.executescript(READ_PRAGMAS)
+                yield con
+            return
+
     with tempfile.TemporaryDirectory() as temp_dir:
         temp_dir = Path(temp_dir)
-        shutil.copy(profile_path / 'places.sqlite', temp_dir)
-        wal_path = profile_path / 'places.sqlite-wal'
+        shutil.copy(db_path, temp_dir)
         if wal_path.exists():
             shutil.copy(wal_path, temp_dir)
 
         with closing(sqlite3.connect(temp_dir / 'places.sqlite')) as con:
+            con.executescript(READ_PRAGMAS)
             yield con
 
 
-def get_bookmarks(profile_path: Path) -> list[Bookmark]:
-    with open_places_db(profile_path) as con:
-        cur = con.cursor()
-
-        # Ignore *Firefox* bookmarks menu official bookmarks
-        cur.execute('SELECT id FROM moz_bookmarks WHERE title LIKE "Mozilla Firefox" AND fk IS NULL')
-        ignored_folders = [res[0] for res in cur.fetchall()]
+def get_places_cache_key(profile_path: Path) -> tuple[tuple[int, int], ...]:
+    """
+    :return: `(st_mtime_ns, st_size)` of `places.sqlite` and its WAL, to detect when the bookmarks may have changed
+    """
+    key = []
+    for name in ('places.sqlite', 'places.sqlite-wal'):
+        try:
+            stat = (profile_path / name).stat()
+        except FileNotFoundError:
+            key.append((0, 0))
+        else:
+            key.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(key)
 
-        # Empty bound parameters aren't allowed
-        if not ignored_folders:
-            ignored_folders = [-1]
 
-        cur.execute(
+def get_bookmarks(profile_path: Path) -> tuple[list[str], list[str]]:
+    """
+    :return: bookmark names and urls, as parallel lists
+    """
+    with open_places_db(profile_path) as con:
+        # Ignore *Firefox* bookmarks menu official bookmarks
+        cur = con.execute(
             """
+            WITH ignored_folders AS (
+              SELECT id FROM moz_bookmarks WHERE title = 'Mozilla Firefox' AND fk IS NULL
+            )
             SELECT moz_bookmarks.title, moz_places.url
             FROM moz_bookmarks
             INNER JOIN moz_places ON moz_bookmarks.fk=moz_places.id
             WHERE moz_bookmarks.fk IS NOT NULL
-              AND moz_bookmarks.parent NOT IN (?)
-            """,
-            ignored_folders,
+              AND moz_bookmarks.parent NOT IN (SELECT id FROM ignored_folders)
+            """
         )
-        return [Bookmark(title or '', url) for title, url in cur]
+        # Fetch rows in batches rather than one at a time
+        cur.arraysize = 1000
+        names, urls = [], []
+        while rows := cur.fetchmany():
+            for title, url in rows:
+                names.append(title or '')
+                urls.append(url)
+        return names, urls
+
+
+class Bookmarks(NamedTuple):
+    """
+    Everything derived from a single read of the database.
+    """
+
+    cache_key: tuple[tuple[int, int], ...] | None
+    names: list[str]
+    urls: list[str]
+    names_lc: list[str]
+    urls_lc: list[str]
+    names_blob: str
+    name_offsets: list[int]
+    urls_blob: str
+    url_offsets: list[int]
+    item_ids: list[str]
+    open_calls: list[Callable[[], None]]
+
+    def find_candidates(self, words: list[str]) -> tuple[Collection[int], Collection[int]]:
+        """
+        :return: indices of the bookmarks whose names, and whose urls, contain the longest of `words`
+        """
+        if not words:
+            indices = range(len(self.names))
+            return indices, indices
+        word = max(words, key=len)
+        return (
+            set(find_containing(self.names_blob, self.name_offsets, word)),
+            set(find_containing(self.urls_blob, self.url_offsets, word)),
+        )
+
+
+def build_bookmarks(names: list[str], urls: list[str], cache_key: tuple[tuple[int, int], ...] | None) -> Bookmarks:
+    names_lc = [normalize(name) for name in names]
+    urls_lc = [normalize(url) for url in urls]
+    names_blob, name_offsets = join_with_offsets(names_lc)
+    urls_blob, url_offsets = join_with_offsets(urls_lc)
+    return Bookmarks(
+        cache_key=cache_key,
+        names=names,
+        urls=urls,
+        names_lc=names_lc,
+        urls_lc=urls_lc,
+        names_blob=names_blob,
+        name_offsets=name_offsets,
+        urls_blob=urls_blob,
+        url_offsets=url_offsets,
+        item_ids=[f'{md_name}/{i}' for i in range(len(names))],
+        open_calls=[partial(runDetachedProcess, ['xdg-open', url]) for url in urls],
+    )
+
+
+def score_bookmarks(bookmarks: Bookmarks, query_string: str) -> list[tuple[tuple[int, float], int]]:
+    """
+    :return: `(score, index)` of each matching bookmark
+    """
+    # Cheaply skip bookmarks that can't match before scoring them
+    words = [word for word in SEPARATOR_RE.split(normalize(query_string)) if word]
+    name_indices, url_indices = bookmarks.find_candidates(words)
+
+    score_text: Callable[[str, str], float | None]
+    if query_string.isascii() and query_string.isalnum():
+        # A single plain word is searched for as a substring, which is much faster than `Matcher`. Candidates are known
+        # to contain it, so only its position is needed, and earlier matches score higher.
+        substring = normalize(query_string)
+
+        def find_substring(_text: str, text_lc: str) -> float | None:
+            return -text_lc.find(substring)
+
+        score_text = find_substring
+        checked_words = []
+    else:
+        match_text = Matcher(query_string).match
+
+        def score_match(text: str, _text_lc: str) -> float | None:
+            match = match_text(text)
+            return match.score if match else None
+
+        score_text = score_match
+        checked_words = words
+
+    scores = []
+    for i in sorted({*name_indices, *url_indices}):
+        score = None
+        if i in name_indices and all(word in bookmarks.names_lc[i] for word in checked_words):
+            text_score = score_text(bookmarks.names[i], bookmarks.names_lc[i])
+            if text_score is not None:
+                score = (2, text_score)
+        # Only probe the url if the name didn't match
+        if score is None and i in url_indices and all(word in bookmarks.urls_lc[i] for word in checked_words):
+            text_score = score_text(bookmarks.urls[i], bookmarks.urls_lc[i])
+            if text_score is not None:
+                score = (1, text_score)
+        if score is None:
+            continue
+        scores.append((score, i))
+    return scores
 
 
 class Plugin(PluginInstance, TriggerQueryHandler):
@@ -104,6 +307,16 @@ class Plugin(PluginInstance, TriggerQueryHandler):
         )
         PluginInstance.__init__(self)
 
+        self._loaded = threading.Event()
+        self._load_error: Exception | None = None
+        self.bookmarks = build_bookmarks([], [], None)
+        self._reload_item = StandardItem(
+            id=f'{md_name}/reload',
+            text='Reload bookmarks database',
+            iconUrls=[ICON_URL],
+            actions=[Action(f'{md_name}/reload', 'Reload bookmarks database', self.reload_bookmarks)],
+        )
+
         settings_path = self.configLocation / 'settings.json'
         if settings_path.exists():
             with settings_path.open() as sr:
@@ -111,49 +324,55 @@ class Plugin(PluginInstance, TriggerQueryHandler):
                 self.profile_path = FIREFOX_DATA_PATH / settings['profileName']
         else:
             self.profile_path = get_profile_path()
-        self.load_bookmarks()
+        # Don't block *Albert* while reading the database
+        threading.Thread(target=self._load_and_signal, daemon=True).start()
+
+    def _load_and_signal(self) -> None:
+        # Errors are shown by queries, as they'd otherwise only reach the thread's stderr
+        try:
+            self.load_bookmarks()
+            self._load_error = None
+        except (OSError, sqlite3.Error, ValueError) as e:
+            self._load_error = e
+        finally:
+            self._loaded.set()
 
     def load_bookmarks(self) -> None:
-        self.bookmarks = get_bookmarks(self.profile_path)
+        cache_key = get_places_cache_key(self.profile_path)
+        if cache_key == self.bookmarks.cache_key:
+            return
+        names, urls = get_bookmarks(self.profile_path)
+        # Swapped in with a single assignment, so queries never see a partial update
+        self.bookmarks = build_bookmarks(names, urls, cache_key)
+
+    def reload_bookmarks(self) -> None:
+        threading.Thread(target=self._load_and_signal, daemon=True).start()
 
     def handleTriggerQuery(self, query) -> None:
-        matcher = Matcher(query.string)
-
-        items_with_score = []
-        for i, (name, url) in enumerate(self.bookmarks):
-            score = None
-            if not score:
-                match = matcher.match(name)
-                if match:
-                    score = (2, match.score)
-            if not score:
-                match = matcher.match(url)
-                if match:
-                    score = (1, match.score)
-            if not score:
-                continue
-            items_with_score.append(
-                (
-                    StandardItem(
-                        id=f'{md_name}/{i}',
-                        text=name,
-                        subtext=url,
-                        iconUrls=[ICON_URL],
-                        actions=[
-                            Action(md_name, f'{md_name}/{i}', lambda url=url: runDetachedProcess(['xdg-open', url]))
-                        ],
-                    ),
-                    score,
+        if not self._loaded.is_set():
+            query.add(StandardItem(id=f'{md_name}/loading', text='Loading bookmarks database...', iconUrls=[ICON_URL]))
+            return
+        if self._load_error is not None:
+            query.add(
+                StandardItem(
+                    id=f'{md_name}/error', text=f'Failed to load bookmarks: {self._load_error}', iconUrls=[ICON_URL]
                 )
             )
-        items_with_score.sort(key=lambda item: item[1], reverse=True)
-        for item, _score in items_with_score:
-            query.add(item)
 
-        item = StandardItem(
-            id=f'{md_name}/reload',
-            text='Reload bookmarks database',
-            iconUrls=[ICON_URL],
-            actions=[Action(f'{md_name}/reload', 'Reload bookmarks database', self.load_bookmarks)],
-        )
-        query.add(item)
+        bookmarks = self.bookmarks
+        scores = score_bookmarks(bookmarks, query.string)
+
+        # Only create items which are shown
+        for _score, i in heapq.nlargest(MAX_RESULTS, scores, key=lambda score_index: score_index[0]):
+            item_id = bookmarks.item_ids[i]
+            query.add(
+                StandardItem(
+                    id=item_id,
+                    text=bookmarks.names[i],
+                    subtext=bookmarks.urls[i],
+                    iconUrls=[ICON_URL],
+                    actions=[Action(md_name, item_id, bookmarks.open_calls[i])],
+                )
+            )
+
+        query.add(self._reload_item)